@@ -1,4 +1,6 @@
+import functools
 import logging
+from collections.abc import Callable
 from copy import copy
 from dataclasses import dataclass, field
 from datetime import datetime
@@ -11,8 +13,16 @@ from machine.logging_config import IndentLogger
 
 logger = IndentLogger(logging.getLogger("service"))
 
+NUMERIC_TYPES = (int, float)
 
-@dataclass
+
+@functools.lru_cache(maxsize=1024)
+def parse_iso(value: str) -> datetime:
+    """Parse an ISO date(time) string; cached as the same few dates are parsed over and over"""
+    return datetime.fromisoformat(value)
+
+
+@dataclass(slots=True)
 class TypeSpec:
     """Specification for value types"""
 
@@ -21,47 +31,58 @@ class TypeSpec:
     precision: int | None = None
     min: int | float | None = None
     max: int | float | None = None
+    enforce: Callable[[Any], Any] = field(init=False, repr=False, compare=False)
 
-    def enforce(self, value: Any) -> Any:
-        """Enforce type specifications on a value"""
-        if self.type == "string":
-            return str(value)
+    def __post_init__(self) -> None:
+        self.enforce = self._build_enforce()
 
-        if value is None:
-            if self.type == "int":
-                return 0
-            if self.type == "float":
-                return 0.0
-            return value
+    def _build_enforce(self) -> Callable[[Any], Any]:
+        """Build the enforce function for this spec once, with its constraints bound as constants"""
+        if self.type == "string":
+            return str
+
+        default = 0 if self.type == "int" else 0.0 if self.type == "float" else None
+        minimum = self.min
+        maximum = self.max
+        precision = self.precision
+        to_cents = self.unit == "eurocent"
+        constrained = minimum is not None or maximum is not None or precision is not None or to_cents
+
+        def enforce(value: Any) -> Any:
+            """Enforce type specifications on a value"""
+            if value is None:
+                return default
+
+            # Convert to numeric if needed
+            if isinstance(value, str):
+                try:
+                    value = float(value)
+                except ValueError:
+                    return value
 
-        # Convert to numeric if needed
-        if isinstance(value, str):
-            try:
-                value = float(value)
-            except ValueError:
+            if not constrained or not isinstance(value, NUMERIC_TYPES):
                 return value
 
-        if not isinstance(value, int | float):
-            return value
+            # Apply min/max constraints
+            if minimum is not None:
+                value = max(value, minimum)
+            if maximum is not None:
+                value = min(value, maximum)
 
-        # Apply min/max constraints
-        if self.min is not None:
-            value = max(value, self.min)
-        if self.max is not None:
-            value = min(value, self.max)
+            # Apply precision
+            if precision is not None:
+                value = round(value, precision)
 
-        # Apply precision
-        if self.precision is not None:
-            value = round(value, self.precision)
+            # Convert to int for cent units
+            if to_cents:
+                value = int(value)
 
-        # Convert to int for cent units
-        if self.unit == "eurocent":
-            value = int(value)
+            return value
 
-        return value
+        return enforce
 
 
-@dataclass
+@dataclass(slots=True)
 class PathNode:
     """Node for tracking evaluation path"""
 
@@ -74,7 +95,7 @@ class PathNode:
     children: list["PathNode"] = field(default_factory=list)
 
 
-@dataclass
+@dataclass(slots=True)
 class RuleContext:
     """Context for rule evaluation"""
 
@@ -84,9 +105,15 @@ class RuleContext:
     property_specs: dict[str, dict[str, Any]]
     output_specs: dict[str, TypeSpec]
     sources: dict[str, pd.DataFrame]
+    overwrite_keys: dict[str, tuple[str, str]] = field(default_factory=dict)
+    source_refs: dict[str, dict[str, Any]] = field(default_factory=dict)
+    service_refs: dict[str, dict[str, Any]] = field(default_factory=dict)
+    required_paths: frozenset[str] = frozenset()
+    property_ids: dict[str, int] = field(default_factory=dict)
     local: dict[str, Any] = field(default_factory=dict)
-    accessed_paths: set[str] = field(default_factory=set)
+    accessed_bits: bytearray = field(init=False, repr=False)
     values_cache: dict[str, Any] = field(default_factory=dict)
+    resolve_cache: dict[str, tuple[Any, str, bool]] = field(default_factory=dict)
     path: list[PathNode] = field(default_factory=list)
     overwrite_input: dict[str, Any] = field(default_factory=dict)
     outputs: dict[str, Any] = field(default_factory=dict)
@@ -95,10 +122,24 @@ class RuleContext:
     service_name: str | None = None
     claims: dict[str:Claim] = None
     approved: bool | None = True
+    trace: bool = False
+    calculation_date_dt: datetime | None = field(init=False, default=None, repr=False)
+
+    def __post_init__(self) -> None:
+        self.accessed_bits = bytearray((len(self.property_ids) + 7) >> 3)
+        if self.calculation_date:
+            self.calculation_date_dt = parse_iso(self.calculation_date)
 
     def track_access(self, path: str) -> None:
-        """Track accessed data paths"""
-        self.accessed_paths.add(path)
+        """Track accessed data paths, as a bit per property in property_ids"""
+        i = self.property_ids.get(path)
+        if i is not None:
+            self.accessed_bits[i >> 3] |= 1 << (i & 7)
+
+    @property
+    def accessed_paths(self) -> set[str]:
+        """Data paths accessed so far"""
+        return {path for path, i in self.property_ids.items() if self.accessed_bits[i >> 3] & (1 << (i & 7))}
 
     def add_to_path(self, node: PathNode) -> None:
         """Add node to evaluation path"""
@@ -119,6 +160,11 @@ class RuleContext:
 
     async def _resolve_value(self, path: str) -> Any:
         """Resolve a value from definitions, services, or sources"""
+        if not self.trace:
+            with logger.indent_block("Resolving %s", path):
+                value, _, _ = await self._lookup_value(path)
+            return value
+
         node = PathNode(
             type="resolve",
             name=f"Resolving value: {path}",
@@ -128,155 +174,146 @@ class RuleContext:
         self.add_to_path(node)
 
         try:
-            with logger.indent_block(f"Resolving {path}"):
-                if not isinstance(path, str) or not path.startswith("$"):
-                    node.result = path
-                    return path
-
-                path = path[1:]  # Remove $ prefix
-                self.track_access(path)
-
-                # Resolve dates
-                value = await self._resolve_date(path)
-                if value is not None:
-                    logger.debug(f"Resolved date ${path}: {value}")
-                    node.result = value
-                    return value
-
-                if "." in path:
-                    root, rest = path.split(".", 1)
-                    value = await self.resolve_value(f"${root}")
-                    for p in rest.split("."):
-                        if value is None:
-                            logger.warning(f"Value is None, could not resolve value ${path}: None")
-                            node.result = None
-                            return None
-                        if isinstance(value, dict):
-                            value = value.get(p)
-                        elif hasattr(value, p):
-                            value = getattr(value, p)
-                        else:
-                            logger.warning(f"Value is not dict or not object, could not resolve value ${path}: None")
-                            node.result = None
-                            return None
-
-                    logger.debug(f"Resolved value ${path}: {value}")
-                    node.result = value
-                    return value
-
-                # Claims first
-                if isinstance(self.claims, dict) and path in self.claims:
-                    claim = self.claims.get(path)
-                    value = claim.new_value
-                    logger.debug(f"Resolving from CLAIM: {value}")
-                    node.result = value
-                    node.resolve_type = "CLAIM"
-                    return value
-
-                # Check local scope
-                if path in self.local:
-                    logger.debug(f"Resolving from LOCAL: {self.local[path]}")
-                    node.result = self.local[path]
-                    node.resolve_type = "LOCAL"
-                    return self.local[path]
-
-                # Check definitions
-                if path in self.definitions:
-                    logger.debug(f"Resolving from DEFINITION: {self.definitions[path]}")
-                    node.result = self.definitions[path]
-                    node.resolve_type = "DEFINITION"
-                    return self.definitions[path]
-
-                # Check parameters
-                if path in self.parameters:
-                    logger.debug(f"Resolving from PARAMETERS: {self.parameters[path]}")
-                    node.result = self.parameters[path]
-                    node.resolve_type = "PARAMETER"
-                    return self.parameters[path]
-
-                # Check outputs
-                if path in self.outputs:
-                    logger.debug(f"Resolving from previous OUTPUT: {self.outputs[path]}")
-                    node.result = self.outputs[path]
-                    node.resolve_type = "OUTPUT"
-                    return self.outputs[path]
-
-                # Check overwrite data
-                if path in self.property_specs:
-                    spec = self.property_specs[path]
-                    service_ref = spec.get("service_reference", {})
-                    if (
-                        service_ref
-                        and service_ref["service"] in self.overwrite_input
-                        and service_ref["field"] in self.overwrite_input[service_ref["service"]]
-                    ):
-                        value = self.overwrite_input[service_ref["service"]][service_ref["field"]]
-                        logger.debug(f"Resolving from OVERWRITE: {value}")
-                        node.result = value
-                        node.resolve_type = "OVERWRITE"
-                        return value
-
-                # Check sources
-                if path in self.property_specs:
-                    spec = self.property_specs[path]
-                    source_ref = spec.get("source_reference", {})
-                    if source_ref:
-                        df = None
-                        table = None
-                        if source_ref.get("source_type") == "laws":
-                            table = "laws"
-                            df = self.service_provider.resolver.rules_dataframe()
-                        if source_ref.get("source_type") == "events":
-                            table = "events"
-                            events = self.service_provider.case_manager.get_events()
-                            df = pd.DataFrame(events)
-                        elif self.sources and "table" in source_ref:
-                            table = source_ref.get("table")
-                            if table in self.sources:
-                                df = self.sources[table]
-
-                        if df is not None:
-                            result = await self._resolve_from_source(source_ref, table, df)
-                            logger.debug(f"Resolving from SOURCE {table}: {result}")
-                            node.result = result
-                            node.resolve_type = "SOURCE"
-                            node.required = bool(spec.get("required", False))
-                            return result
-
-                # Check services
-                if path in self.property_specs:
-                    spec = self.property_specs[path]
-                    service_ref = spec.get("service_reference", {})
-                    if service_ref and self.service_provider:
-                        value = await self._resolve_from_service(path, service_ref, spec)
-                        logger.debug(
-                            f"Result for ${path} from {service_ref['service']} field {service_ref['field']}: {value}"
-                        )
-                        node.result = value
-                        node.resolve_type = "SERVICE"
-                        node.required = bool(spec.get("required", False))
-                        return value
-
-                logger.warning(f"Could not resolve value for {path}")
-                node.result = None
-                node.resolve_type = "NONE"
-
-                if path in self.property_specs:
-                    spec = self.property_specs[path]
-                    node.required = bool(spec.get("required", False))
-
-                return None
+            with logger.indent_block("Resolving %s", path):
+                node.result, node.resolve_type, node.required = await self._lookup_value(path)
+                return node.result
         finally:
             self.pop_path()
 
+    async def _lookup_value(self, path: str) -> tuple[Any, str | None, bool]:
+        """Look up a value, together with where it was resolved from and whether it is required"""
+        if not isinstance(path, str) or not path.startswith("$"):
+            return path, None, False
+
+        path = path[1:]  # Remove $ prefix
+        self.track_access(path)
+
+        # Resolve dates
+        value = await self._resolve_date(path)
+        if value is not None:
+            logger.debug("Resolved date $%s: %s", path, value)
+            return value, None, False
+
+        if "." in path:
+            root, rest = path.split(".", 1)
+            value = await self.resolve_value(f"${root}")
+            for p in rest.split("."):
+                if value is None:
+                    logger.warning(f"Value is None, could not resolve value ${path}: None")
+                    return None, None, False
+                if isinstance(value, dict):
+                    value = value.get(p)
+                elif hasattr(value, p):
+                    value = getattr(value, p)
+                else:
+                    logger.warning(f"Value is not dict or not object, could not resolve value ${path}: None")
+                    return None, None, False
+
+            logger.debug("Resolved value $%s: %s", path, value)
+            return value, None, False
+
+        # Claims first
+        if isinstance(self.claims, dict) and path in self.claims:
+            claim = self.claims.get(path)
+            value = claim.new_value
+            logger.debug("Resolving from CLAIM: %s", value)
+            return value, "CLAIM", False
+
+        # Check local scope
+        if path in self.local:
+            logger.debug("Resolving from LOCAL: %s", self.local[path])
+            return self.local[path], "LOCAL", False
+
+        # Check definitions
+        if path in self.definitions:
+            logger.debug("Resolving from DEFINITION: %s", self.definitions[path])
+            return self.definitions[path], "DEFINITION", False
+
+        # Check parameters
+        if path in self.parameters:
+            logger.debug("Resolving from PARAMETERS: %s", self.parameters[path])
+            return self.parameters[path], "PARAMETER", False
+
+        # Check outputs
+        if path in self.outputs:
+            logger.debug("Resolving from previous OUTPUT: %s", self.outputs[path])
+            return self.outputs[path], "OUTPUT", False
+
+        # Reuse an earlier resolution from the specs. This assumes the references a spec resolves on the way
+        # (service parameters, temporal reference, select_on values) are fixed for the whole evaluation.
+        # Skipped inside a local scope, which could change the outcome, and when tracing, so that every
+        # resolve node keeps its nested resolves.
+        use_cache = not self.local and not self.trace
+        if use_cache and path in self.resolve_cache:
+            resolution = self.resolve_cache[path]
+            logger.debug("Resolving from CACHE (%s): %s", resolution[1], resolution[0])
+            return resolution
+
+        resolution = await self._resolve_from_specs(path)
+        if use_cache:
+            self.resolve_cache[path] = resolution
+        return resolution
+
+    async def _resolve_from_specs(self, path: str) -> tuple[Any, str, bool]:
+        """Resolve a value through its property spec: overwrites, sources or services"""
+        # Check overwrite data
+        overwrite_key = self.overwrite_keys.get(path)
+        if overwrite_key is not None:
+            service, field_name = overwrite_key
+            service_overwrites = self.overwrite_input.get(service)
+            if service_overwrites is not None and field_name in service_overwrites:
+                value = service_overwrites[field_name]
+                logger.debug("Resolving from OVERWRITE: %s", value)
+                return value, "OVERWRITE", False
+
+        if path not in self.property_specs:
+            logger.warning(f"Could not resolve value for {path}")
+            return None, "NONE", False
+
+        required = path in self.required_paths
+
+        # Check sources
+        source_ref = self.source_refs.get(path)
+        if source_ref is not None:
+            df = None
+            table = None
+            if source_ref.get("source_type") == "laws":
+                table = "laws"
+                df = self.service_provider.resolver.rules_dataframe()
+            if source_ref.get("source_type") == "events":
+                table = "events"
+                events = self.service_provider.case_manager.get_events()
+                df = pd.DataFrame(events)
+            elif self.sources and "table" in source_ref:
+                table = source_ref.get("table")
+                if table in self.sources:
+                    df = self.sources[table]
+
+            if df is not None:
+                result = await self._resolve_from_source(source_ref, table, df)
+                logger.debug("Resolving from SOURCE %s: %s", table, result)
+                return result, "SOURCE", required
+
+        # Check services
+        service_ref = self.service_refs.get(path)
+        if service_ref is not None and self.service_provider:
+            value = await self._resolve_from_service(path, service_ref, self.property_specs[path])
+            logger.debug(
+                "Result for $%s from %s field %s: %s", path, service_ref["service"], service_ref["field"], value
+            )
+            return value, "SERVICE", required
+
+        logger.warning(f"Could not resolve value for {path}")
+        return None, "NONE", required
+
     async def _resolve_date(self, path):
         if path == "calculation_date":
             return self.calculation_date
         if path == "january_first":
-            calc_date = datetime.strptime(self.calculation_date, "%Y-%m-%d").date()
+            calc_date = self.calculation_date_dt.date()
             return calc_date.replace(month=1, day=1).isoformat()
         if path == "prev_january_first":
-            calc_date = datetime.strptime(self.calculation_date, "%Y-%m-%d").date()
+            calc_date = self.calculation_date_dt.date()
             return calc_date.replace(month=1, day=1, year=calc_date.year - 1).isoformat()
         if path == "year":
             return self.calculation_date[:4]
@@ -294,26 +331,28 @@ class RuleContext:
         # Check cache
         cache_key = f"{path}({','.join([f'{k}:{v}' for k, v in sorted(parameters.items())])},{reference_date})"
         if cache_key in self.values_cache:
-            logger.debug(f"Resolving from CACHE with key '{cache_key}': {self.values_cache[cache_key]}")
+            logger.debug("Resolving from CACHE with key '%s': %s", cache_key, self.values_cache[cache_key])
             return self.values_cache[cache_key]
 
-        logger.debug(f"Resolving from {service_ref['service']} field {service_ref['field']} ({parameters})")
+        logger.debug("Resolving from %s field %s (%s)", service_ref["service"], service_ref["field"], parameters)
 
         # Create service evaluation node
-        service_node = PathNode(
-            type="service_evaluation",
-            name=f"Service call: {service_ref['service']}.{service_ref['law']}",
-            result=None,
-            details={
-                "service": service_ref["service"],
-                "law": service_ref["law"],
-                "field": service_ref["field"],
-                "reference_date": reference_date,
-                "parameters": parameters,
-                "path": path,
-            },
-        )
-        self.add_to_path(service_node)
+        service_node = None
+        if self.trace:
+            service_node = PathNode(
+                type="service_evaluation",
+                name=f"Service call: {service_ref['service']}.{service_ref['law']}",
+                result=None,
+                details={
+                    "service": service_ref["service"],
+                    "law": service_ref["law"],
+                    "field": service_ref["field"],
+                    "reference_date": reference_date,
+                    "parameters": parameters,
+                    "path": path,
+                },
+            )
+            self.add_to_path(service_node)
 
         try:
             result = await self.service_provider.evaluate(
@@ -324,18 +363,21 @@ class RuleContext:
                 self.overwrite_input,
                 requested_output=service_ref["field"],
                 approved=self.approved,
+                trace=self.trace,
             )
 
             value = result.output.get(service_ref["field"])
             self.values_cache[cache_key] = value
 
             # Update the service node with the result and add child path
-            service_node.result = value
-            service_node.children.append(result.path)
+            if service_node is not None:
+                service_node.result = value
+                service_node.children.append(result.path)
 
             return value
         finally:
-            self.pop_path()
+            if service_node is not None:
+                self.pop_path()
 
     async def _resolve_from_source(self, source_ref, table, df):
         if "select_on" in source_ref:
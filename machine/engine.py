@@ -1,13 +1,52 @@
+import bisect
 import functools
+import inspect
+import itertools
+import math
 import operator
 from collections import defaultdict
+from collections.abc import Awaitable, Callable
 from copy import copy
 from datetime import date, datetime
 from typing import Any
 
 import pandas as pd
 
-from .context import PathNode, RuleContext, TypeSpec, logger
+from .context import PathNode, RuleContext, TypeSpec, logger, parse_iso
+
+# Compiled evaluators are either async or, for subtrees without references, plain sync callables
+Evaluator = Callable[[RuleContext], Awaitable[Any] | Any]
+OperationBody = Callable[[RuleContext, PathNode], Awaitable[Any] | Any]
+
+
+def _multiply(values: list[Any]) -> Any:
+    """
+    Multiply values from left to right. Multiplying by an int below 1 truncates the product to an int,
+    which only needs the per element check when such a factor is present.
+    """
+    factors = values[1:]
+    if not any(isinstance(y, int) and y < 1 for y in factors):
+        return math.prod(factors, start=values[0])
+    return functools.reduce(lambda x, y: int(x * y) if isinstance(y, int) and y < 1 else x * y, factors, values[0])
+
+
+def _subtract(values: list[Any]) -> Any:
+    """Subtract the remaining values from the first one"""
+    result = values[0]
+    for value in values[1:]:
+        result = result - value
+    return result
+
+
+def _divide(values: list[Any]) -> Any:
+    """Divide the first value by the remaining ones, as a float. Dividing by zero gives 0."""
+    divisors = values[1:]
+    if 0 in divisors:
+        return 0
+    result = float(values[0])
+    for divisor in divisors:
+        result = result / divisor
+    return result
 
 
 class RulesEngine:
@@ -22,9 +61,22 @@ class RulesEngine:
         self.parameter_specs = spec.get("properties", {}).get("parameters", {})
         self.property_specs = self._build_property_specs(spec.get("properties", {}))
         self.output_specs = self._build_output_specs(spec.get("properties", {}))
+        self._output_spec_by_name = self._build_output_spec_by_name(spec.get("properties", {}))
+        self.overwrite_keys = self._build_overwrite_keys(self.property_specs)
+        self.source_refs = self._build_references(self.property_specs, "source_reference")
+        self.service_refs = self._build_references(self.property_specs, "service_reference")
+        self.required_paths = frozenset(path for path, spec in self.property_specs.items() if spec.get("required"))
+        self.property_ids = {path: i for i, path in enumerate(self.property_specs)}
         self.definitions = spec.get("properties", {}).get("definitions", {})
         self.service_provider = service_provider
 
+        # Compile the rule trees once, so evaluation does not have to interpret the raw spec
+        self._compiled_requirements = [self._compile_requirement(req) for req in self.requirements]
+        # Keyed by the action itself, as output names are not guaranteed to be unique
+        self._compiled_actions = {id(action): self._compile_action(action) for action in self.actions}
+        # Action plans per requested output; the dependency graph is fixed for the lifetime of the engine
+        self._required_actions: dict[str | None, list] = {}
+
     @staticmethod
     def _build_property_specs(properties: dict[str, Any]) -> dict[str, dict[str, Any]]:
         """Build mapping of property paths to their specifications"""
@@ -42,6 +94,21 @@ class RulesEngine:
 
         return specs
 
+    @staticmethod
+    def _build_overwrite_keys(property_specs: dict[str, dict[str, Any]]) -> dict[str, tuple[str, str]]:
+        """Build mapping of property paths to the (service, field) under which they can be overwritten"""
+        keys = {}
+        for path, spec in property_specs.items():
+            service_ref = spec.get("service_reference")
+            if service_ref:
+                keys[path] = (service_ref["service"], service_ref["field"])
+        return keys
+
+    @staticmethod
+    def _build_references(property_specs: dict[str, dict[str, Any]], kind: str) -> dict[str, dict[str, Any]]:
+        """Build flat mapping of property paths to their source or service reference"""
+        return {path: spec[kind] for path, spec in property_specs.items() if spec.get(kind)}
+
     @staticmethod
     def _build_output_specs(properties: dict[str, Any]) -> dict[str, TypeSpec]:
         """Build mapping of output names to their type specifications"""
@@ -58,6 +125,15 @@ class RulesEngine:
                 )
         return specs
 
+    @staticmethod
+    def _build_output_spec_by_name(properties: dict[str, Any]) -> dict[str, dict[str, Any]]:
+        """Build mapping of output names to their raw definitions, keeping the first one per name"""
+        specs = {}
+        for output in properties.get("output", []):
+            if "name" in output:
+                specs.setdefault(output["name"], output)
+        return specs
+
     def _enforce_output_type(self, name: str, value: Any) -> Any:
         """Enforce type specifications on output value"""
         if name in self.output_specs:
@@ -161,6 +237,14 @@ class RulesEngine:
         # Return actions in dependency order
         return [action_by_output[output] for output in ordered_outputs if output in action_by_output]
 
+    def _get_required_actions(self, requested_output: str | None) -> list:
+        """Get the (cached) actions needed to compute requested output in dependency order"""
+        required_actions = self._required_actions.get(requested_output)
+        if required_actions is None:
+            required_actions = self.get_required_actions(requested_output, self.actions)
+            self._required_actions[requested_output] = required_actions
+        return required_actions
+
     async def evaluate(
         self,
         parameters: dict[str, Any] | None = None,
@@ -169,15 +253,21 @@ class RulesEngine:
         calculation_date=None,
         requested_output: str | None = None,
         approved: bool = False,
+        trace: bool = False,
     ) -> dict[str, Any]:
-        """Evaluate rules using service context and sources"""
+        """
+        Evaluate rules using service context and sources.
+        The evaluation path is only recorded (and returned as "path") when trace is set.
+        """
         parameters = parameters or {}
         for p in self.parameter_specs:
             if p["required"] and p["name"] not in parameters:
                 logger.warning(f"Required parameter {p} not found in {parameters}")
 
-        logger.debug(f"Evaluating rules for {self.service_name} {self.law} ({calculation_date} {requested_output})")
-        root = PathNode(type="root", name="evaluation", result=None)
+        logger.debug(
+            "Evaluating rules for %s %s (%s %s)", self.service_name, self.law, calculation_date, requested_output
+        )
+        root = PathNode(type="root", name="evaluation", result=None) if trace else None
 
         claims = None
         if "BSN" in parameters:
@@ -192,28 +282,37 @@ class RulesEngine:
             parameters=parameters,
             property_specs=self.property_specs,
             output_specs=self.output_specs,
+            overwrite_keys=self.overwrite_keys,
+            source_refs=self.source_refs,
+            service_refs=self.service_refs,
+            required_paths=self.required_paths,
+            property_ids=self.property_ids,
             sources=sources,
-            path=[root],
+            path=[root] if trace else [],
             overwrite_input=overwrite_input or {},
             calculation_date=calculation_date,
             service_name=self.service_name,
             claims=claims,
             approved=approved,
+            trace=trace,
         )
 
         # Check requirements
-        requirements_node = PathNode(type="requirements", name="Check all requirements", result=None)
-        context.add_to_path(requirements_node)
-        try:
-            requirements_met = await self._evaluate_requirements(self.requirements, context)
-            requirements_node.result = requirements_met
-        finally:
-            context.pop_path()
+        if trace:
+            requirements_node = PathNode(type="requirements", name="Check all requirements", result=None)
+            context.add_to_path(requirements_node)
+            try:
+                requirements_met = await self._evaluate_requirements(context)
+                requirements_node.result = requirements_met
+            finally:
+                context.pop_path()
+        else:
+            requirements_met = await self._evaluate_requirements(context)
 
         output_values = {}
         if requirements_met:
             # Get required actions including dependencies in order
-            required_actions = self.get_required_actions(requested_output, self.actions)
+            required_actions = self._get_required_actions(requested_output)
 
             for action in required_actions:
                 output_def, output_name = await self._evaluate_action(action, context)
@@ -231,33 +330,28 @@ class RulesEngine:
         }
 
     async def _evaluate_action(self, action, context):
-        with logger.indent_block(f"Computing {action.get('output', '')}"):
-            action_node = PathNode(
-                type="action",
-                name=f"Evaluate action for {action.get('output', '')}",
-                result=None,
-            )
-            context.add_to_path(action_node)
+        with logger.indent_block("Computing %s", action.get("output", "")):
+            action_node = None
+            if context.trace:
+                action_node = PathNode(
+                    type="action",
+                    name=f"Evaluate action for {action.get('output', '')}",
+                    result=None,
+                )
+                context.add_to_path(action_node)
             output_name = action["output"]
-            # Find output specification
-            output_spec = next(
-                (spec for spec in self.spec.get("properties", {}).get("output", []) if spec.get("name") == output_name),
-                {},
-            )
+            output_spec = self._output_spec_by_name.get(output_name, {})
 
-            if (
-                self.service_name in context.overwrite_input
-                and output_name in context.overwrite_input[self.service_name]
-            ):
-                raw_result = context.overwrite_input[self.service_name][output_name]
-                logger.debug(f"Resolving value {self.service_name}/{output_name} from OVERWRITE {raw_result}")
-            elif "value" in action:
-                raw_result = await self._evaluate_value(action["value"], context)
+            service_overwrites = context.overwrite_input.get(self.service_name)
+            if service_overwrites is not None and output_name in service_overwrites:
+                raw_result = service_overwrites[output_name]
+                logger.debug("Resolving value %s/%s from OVERWRITE %s", self.service_name, output_name, raw_result)
             else:
-                raw_result = await self._evaluate_operation(action, context)
+                raw_result = await self._compiled_actions[id(action)](context)
             result = self._enforce_output_type(output_name, raw_result)
-        action_node.result = result
-        logger.debug(f"Result of {action.get('output', '')}: {result}")
+        if action_node is not None:
+            action_node.result = result
+        logger.debug("Result of %s: %s", action.get("output", ""), result)
         # Build output with metadata
         output_def = {
             "value": result,
@@ -272,362 +366,722 @@ class RulesEngine:
             output_def["temporal"] = output_spec["temporal"]
         return output_def, output_name
 
-    async def _evaluate_requirements(self, requirements: list, context: RuleContext) -> bool:
+    async def _evaluate_requirements(self, context: RuleContext) -> bool:
         """Evaluate all requirements"""
-        if not requirements:
+        if not self._compiled_requirements:
             logger.debug("No requirements found")
             return True
 
-        for req in requirements:
-            with logger.indent_block(f"Requirements {req}"):
-                node = PathNode(
-                    type="requirement",
-                    name="Check ALL conditions"
-                    if "all" in req
-                    else "Check OR conditions"
-                    if "or" in req
-                    else "Test condition",
-                    result=None,
-                )
-                context.add_to_path(node)
-
-                if "all" in req:
-                    results = []
-                    for r in req["all"]:
-                        result = await self._evaluate_requirements([r], context)
-                        results.append(result)
-                    result = all(results)
-                elif "or" in req:
-                    results = []
-                    for r in req["or"]:
-                        result = await self._evaluate_requirements([r], context)
-                        results.append(result)
-                    result = any(results)
-                else:
-                    result = await self._evaluate_operation(req, context)
-
-            logger.debug("Requirement met" if result else "Requirement NOT met")
-
-            node.result = result
-            context.pop_path()
-
-            if not result:
+        for requirement in self._compiled_requirements:
+            if not await requirement(context):
                 return False
 
         return True
 
-    async def _evaluate_if_operation(self, operation: dict[str, Any], context: RuleContext) -> Any:
-        """Evaluate an IF operation"""
-        if_node = PathNode(
-            type="operation",
-            name="IF conditions",
-            result=None,
-            details={"condition_results": []},
-        )
-        context.add_to_path(if_node)
+    def _compile_action(self, action: dict[str, Any]) -> Evaluator:
+        """Compile the value or operation of an action into an async evaluator"""
+        evaluate = self._compile_value(action["value"]) if "value" in action else self._compile_operation(action)
+        if inspect.iscoroutinefunction(evaluate):
+            return evaluate
 
-        result = 0
-        conditions = operation.get("conditions", [])
+        async def evaluate_action(context: RuleContext) -> Any:
+            return evaluate(context)
 
-        for i, condition in enumerate(conditions):
-            condition_result = {
-                "condition_index": i,
-                "type": "test" if "test" in condition else "else",
-            }
+        return evaluate_action
 
-            if "test" in condition:
-                test_result = await self._evaluate_operation(condition["test"], context)
-                condition_result["test_result"] = test_result
-                if test_result:
-                    result = await self._evaluate_value(condition["then"], context)
-                    condition_result["then_value"] = result
-                    if_node.details["condition_results"].append(condition_result)
-                    break
-            elif "else" in condition:
-                result = await self._evaluate_value(condition["else"], context)
-                condition_result["else_value"] = result
-                if_node.details["condition_results"].append(condition_result)
-                break
+    def _compile_requirement(self, req: dict[str, Any]) -> Evaluator:
+        """Compile a single requirement, including nested all/or groups"""
+        message = f"Requirements {req}"
+        try:
+            if "all" in req:
+                name = "Check ALL conditions"
+                children = [self._compile_requirement(r) for r in req["all"]]
+                combine = all
+            elif "or" in req:
+                name = "Check OR conditions"
+                children = [self._compile_requirement(r) for r in req["or"]]
+                combine = any
+            else:
+                name = "Test condition"
+                children = None
+                test = self._compile_operation(req)
+                test_async = inspect.iscoroutinefunction(test)
+        except (KeyError, IndexError, TypeError) as e:
+            # A malformed requirement only fails when it is evaluated, not when the law is loaded
+            return self._compile_failure(e)
+
+        async def evaluate_requirement(context: RuleContext) -> bool:
+            with logger.indent_block(message):
+                node = None
+                if context.trace:
+                    node = PathNode(type="requirement", name=name, result=None)
+                    context.add_to_path(node)
+
+                if children is not None:
+                    # Evaluate every child so the path shows all (un)met conditions
+                    result = combine([bool(await child(context)) for child in children])
+                else:
+                    result = await test(context) if test_async else test(context)
 
-            if_node.details["condition_results"].append(condition_result)
+            logger.debug("Requirement met" if result else "Requirement NOT met")
 
-        if_node.result = result
-        context.pop_path()
-        return result
+            if node is not None:
+                node.result = result
+                context.pop_path()
+            return result
 
-    async def _evaluate_foreach(self, operation, context):
-        """Handle FOREACH operation"""
-        combine = operation.get("combine")
+        return evaluate_requirement
 
-        array_data = await self._evaluate_value(operation["subject"], context)
-        if not array_data:
-            logger.warning("No data found to run FOREACH on")
-            return self._evaluate_aggregate_ops(combine, [])
-
-        if not isinstance(array_data, list):
-            array_data = [array_data]
-
-        with logger.indent_block(f"Foreach({combine})"):
-            values = []
-            for item in array_data:
-                with logger.indent_block(f"Item {item}"):
-                    item_context = copy(context)
-                    item_context.local = item
-                    value_to_evaluate = (
-                        operation["value"][0] if isinstance(operation["value"], list) else operation["value"]
-                    )
-                    result = await self._evaluate_value(value_to_evaluate, item_context)
-                    values.extend(result if isinstance(result, list) else [result])
-            logger.debug(f"Foreach values: {values}")
-            result = self._evaluate_aggregate_ops(combine, values)
-            logger.debug(f"Foreach result: {result}")
-        return result
+    def _compile_value(self, value: Any) -> Evaluator:
+        """
+        Compile a value which might be a number, operation, or reference.
+        Only references can need async work, literals (and operations on literals) compile to sync evaluators.
+        """
+        if isinstance(value, int | float | bool | date | datetime):
 
-    COMPARISON_OPS = {
-        "EQUALS": operator.eq,
-        "NOT_EQUALS": operator.ne,
-        "GREATER_THAN": operator.gt,
-        "LESS_THAN": operator.lt,
-        "GREATER_OR_EQUAL": operator.ge,
-        "LESS_OR_EQUAL": operator.le,
-    }
+            def evaluate_literal(context: RuleContext) -> Any:
+                return value
 
-    AGGREGATE_OPS = {
-        "OR": any,
-        "AND": all,
-        "MIN": min,
-        "MAX": max,
-        "ADD": sum,
-        "CONCAT": lambda vals: "".join(str(x) for x in vals),
-        "MULTIPLY": lambda vals: functools.reduce(
-            lambda x, y: int(x * y) if isinstance(y, int) and y < 1 else x * y,
-            vals[1:],
-            vals[0],
-        ),
-        "SUBTRACT": lambda vals: functools.reduce(operator.sub, vals[1:], vals[0]),
-        "DIVIDE": lambda vals: (
-            functools.reduce(lambda x, y: x / y if y != 0 else 0, vals[1:], float(vals[0])) if 0 not in vals[1:] else 0
-        ),
-    }
+            return evaluate_literal
+        elif isinstance(value, dict) and "operation" in value:
+            return self._compile_operation(value)
+        else:
+            return inspect.markcoroutinefunction(lambda context: context.resolve_value(value))
 
     @staticmethod
-    def _evaluate_aggregate_ops(op: str, values: list[Any]) -> int | float | bool:
-        """Handle aggregate operations"""
-        filtered_values = [v for v in values if v is not None]
+    def _compile_operands(evaluators: list[Evaluator], finish: Callable[[PathNode, list[Any]], Any]) -> OperationBody:
+        """
+        Compile an operation body that evaluates all operands in order and passes their values to finish.
+        The body is sync when none of the operands needs to be awaited.
+        """
+        operands = [(evaluate, inspect.iscoroutinefunction(evaluate)) for evaluate in evaluators]
 
-        if not filtered_values:
-            logger.warning(f"No values found (or they where None), returning 0 for {op}({values})")
-            return 0
-        elif len(filtered_values) < len(values):
-            logger.warning(f"Dropped {len(values) - len(filtered_values)} values because they where None")
+        if not any(is_async for _, is_async in operands):
 
-        result = RulesEngine.AGGREGATE_OPS[op](filtered_values)
-        logger.debug(f"Compute {op}({filtered_values}) = {result}")
-        return result
+            def evaluate_operands_sync(context: RuleContext, node: PathNode) -> Any:
+                return finish(node, [evaluate(context) for evaluate, _ in operands])
 
-    @staticmethod
-    def _evaluate_comparison(op: str, left: Any, right: Any) -> bool | None:
-        """Handle comparison operations"""
-        if isinstance(left, date) and isinstance(right, str):
-            right = datetime.strptime(right, "%Y-%m-%d").date()
-        elif isinstance(right, date) and isinstance(left, str):
-            left = datetime.strptime(left, "%Y-%m-%d").date()
+            return evaluate_operands_sync
 
-        try:
-            result = RulesEngine.COMPARISON_OPS[op](left, right)
-            logger.debug(f"Compute {op}({left}, {right}) = {result}")
-        except TypeError as e:
-            logger.warning(f"Error computing {op}({left}, {right}): {e}")
-            result = None
+        async def evaluate_operands(context: RuleContext, node: PathNode) -> Any:
+            values = [await evaluate(context) if is_async else evaluate(context) for evaluate, is_async in operands]
+            return finish(node, values)
 
-        return result
+        return evaluate_operands
 
     @staticmethod
-    def _evaluate_date_operation(op: str, values: list[Any], unit: str) -> int:
-        """Handle date-specific operations"""
-        result = None
-        if op == "SUBTRACT_DATE":
-            if len(values) != 2:
-                logger.warning("Warning: SUBTRACT_DATE requires exactly 2 values")
-                return 0
-
-            end_date, start_date = values
-
-            if not isinstance(end_date, datetime):
-                end_date = datetime.fromisoformat(str(end_date))
-            if not isinstance(start_date, datetime):
-                start_date = datetime.fromisoformat(str(start_date))
-
-            delta = end_date - start_date
-
-            if unit == "days":
-                result = delta.days
-            elif unit == "years":
-                result = (
-                    end_date.year
-                    - start_date.year
-                    - ((end_date.month, end_date.day) < (start_date.month, start_date.day))
-                )
-            elif unit == "months":
-                result = (end_date.year - start_date.year) * 12 + end_date.month - start_date.month
-            else:
-                logger.warning(f"Warning: Unknown date unit {unit}")
-            logger.debug(f"Compute {op}({values}, {unit}) = {result}")
-
-        if result is None:
-            logger.warning("Warning: date operation resulted in None")
-
-        return result
+    def _compile_traced_value(node_type: str, name: str, raw_value: Any, evaluate: Evaluator) -> Evaluator:
+        """Wrap a compiled value in a path node recording the raw value"""
+        if not inspect.iscoroutinefunction(evaluate):
+
+            def evaluate_traced_value_sync(context: RuleContext) -> Any:
+                if not context.trace:
+                    return evaluate(context)
+                node = PathNode(type=node_type, name=name, result=None, details={"raw_value": raw_value})
+                context.add_to_path(node)
+                result = evaluate(context)
+                node.result = result
+                context.pop_path()
+                return result
 
-    async def _evaluate_operation(self, operation: dict[str, Any], context: RuleContext) -> Any:
-        """Evaluate an operation or condition"""
+            return evaluate_traced_value_sync
 
-        if not isinstance(operation, dict):
-            node = PathNode(
-                type="value",
-                name="Direct value evaluation",
-                result=None,
-                details={"raw_value": operation},
-            )
+        async def evaluate_traced_value(context: RuleContext) -> Any:
+            if not context.trace:
+                return await evaluate(context)
+            node = PathNode(type=node_type, name=name, result=None, details={"raw_value": raw_value})
             context.add_to_path(node)
-            result = await self._evaluate_value(operation, context)
+            result = await evaluate(context)
             node.result = result
             context.pop_path()
             return result
 
+        return evaluate_traced_value
+
+    def _compile_operation(self, operation: Any) -> Evaluator:
+        """Compile an operation or condition into an evaluator"""
+        if not isinstance(operation, dict):
+            return self._compile_traced_value(
+                "value", "Direct value evaluation", operation, self._compile_value(operation)
+            )
+
         # Direct value assignment - no operation needed
         if "value" in operation and not operation.get("operation"):
+            return self._compile_traced_value(
+                "direct_value", "Direct value assignment", operation["value"], self._compile_value(operation["value"])
+            )
+
+        op_type = operation.get("operation")
+        name = f"Operation: {op_type}"
+        body = self._compile_operation_body(op_type, operation)
+
+        if not inspect.iscoroutinefunction(body):
+
+            def evaluate_operation_sync(context: RuleContext) -> Any:
+                if not context.trace:
+                    return body(context, None)
+                node = PathNode(
+                    type="operation",
+                    name=name,
+                    result=None,
+                    details={"operation_type": op_type},
+                )
+                context.add_to_path(node)
+                result = body(context, node)
+                node.result = result
+                context.pop_path()
+                return result
+
+            return evaluate_operation_sync
+
+        async def evaluate_operation(context: RuleContext) -> Any:
+            if not context.trace:
+                return await body(context, None)
             node = PathNode(
-                type="direct_value",
-                name="Direct value assignment",
+                type="operation",
+                name=name,
                 result=None,
-                details={"raw_value": operation["value"]},
+                details={"operation_type": op_type},
             )
             context.add_to_path(node)
-            result = await self._evaluate_value(operation["value"], context)
+            result = await body(context, node)
             node.result = result
             context.pop_path()
             return result
 
-        op_type = operation.get("operation")
-        node = PathNode(
-            type="operation",
-            name=f"Operation: {op_type}",
-            result=None,
-            details={"operation_type": op_type},
-        )
-        context.add_to_path(node)
+        return evaluate_operation
 
+    def _compile_operation_body(self, op_type: str | None, operation: dict[str, Any]) -> OperationBody:
+        """Compile the operation specific part of an operation, which fills in the details of its node"""
         if op_type is None:
-            logger.warning("Operation type is None (or missing).")
-            result = None
 
-        elif op_type == "IF":
-            result = await self._evaluate_if_operation(operation, context)
+            def evaluate_missing(context: RuleContext, node: PathNode) -> None:
+                logger.warning("Operation type is None (or missing).")
+
+            return evaluate_missing
+
+        try:
+            handler = self.OP_HANDLERS.get(op_type)
+            if handler is None and "_DATE" in op_type:
+                handler = RulesEngine._compile_date_operation
+            if handler is None:
+                return self._compile_invalid_operation(op_type)
+            return handler(self, op_type, operation)
+        except (KeyError, IndexError, TypeError) as e:
+            # A malformed operation only fails when it is evaluated, not when the law is loaded
+            return self._compile_failure(e)
+
+    @staticmethod
+    def _compile_failure(error: Exception) -> Callable[..., Any]:
+        """Compile an evaluator that raises the error met while compiling, once it is evaluated"""
+        error_type, args = type(error), error.args
+
+        def evaluate_failure(*_: Any) -> Any:
+            raise error_type(*args)
 
-        elif op_type == "FOREACH":
-            result = await self._evaluate_foreach(operation, context)
-            node.details.update({"raw_values": operation["value"], "arithmetic_type": op_type})
+        return evaluate_failure
 
-        elif op_type in ["IN", "NOT_IN"]:
+    @staticmethod
+    def _compile_invalid_operation(op_type: str) -> OperationBody:
+        """Compile an operation that could not be matched to any known operation"""
+
+        def evaluate_invalid(context: RuleContext, node: PathNode) -> None:
+            if node is not None:
+                node.details["error"] = "Invalid operation format"
+            logger.warning(f"Not matched to any operation {op_type}")
+
+        return evaluate_invalid
+
+    def _compile_in(self, op_type: str, operation: dict[str, Any]) -> OperationBody:
+        """Compile an IN or NOT_IN operation"""
+        subject_evaluator = self._compile_value(operation["subject"])
+        subject_async = inspect.iscoroutinefunction(subject_evaluator)
+        allowed_evaluator = self._compile_value(operation.get("values", []))
+        allowed_async = inspect.iscoroutinefunction(allowed_evaluator)
+        negate = op_type == "NOT_IN"
+
+        async def evaluate_in(context: RuleContext, node: PathNode) -> bool:
             with logger.indent_block(op_type):
-                subject = await self._evaluate_value(operation["subject"], context)
-                allowed_values = await self._evaluate_value(operation.get("values", []), context)
+                subject = await subject_evaluator(context) if subject_async else subject_evaluator(context)
+                allowed_values = await allowed_evaluator(context) if allowed_async else allowed_evaluator(context)
                 result = subject in (allowed_values if isinstance(allowed_values, list) else [allowed_values])
-                if op_type == "NOT_IN":
+                if negate:
                     result = not result
 
-            node.details.update({"subject_value": subject, "allowed_values": allowed_values})
-            logger.debug(f"Result {subject} {op_type} {allowed_values}: {result}")
+            if node is not None:
+                node.details.update({"subject_value": subject, "allowed_values": allowed_values})
+            logger.debug("Result %s %s %s: %s", subject, op_type, allowed_values, result)
+            return result
+
+        return evaluate_in
+
+    def _compile_not_null(self, op_type: str, operation: dict[str, Any]) -> OperationBody:
+        """Compile a NOT_NULL operation"""
+        subject_evaluator = self._compile_value(operation["subject"])
+        subject_async = inspect.iscoroutinefunction(subject_evaluator)
 
-        elif op_type == "NOT_NULL":
-            subject = await self._evaluate_value(operation["subject"], context)
-            result = subject is not None
-            node.details["subject_value"] = subject
+        async def evaluate_not_null(context: RuleContext, node: PathNode) -> bool:
+            subject = await subject_evaluator(context) if subject_async else subject_evaluator(context)
+            if node is not None:
+                node.details["subject_value"] = subject
+            return subject is not None
 
-        elif op_type == "AND":
+        return evaluate_not_null
+
+    def _compile_and(self, op_type: str, operation: dict[str, Any]) -> OperationBody:
+        """Compile an AND operation, which stops at the first false value"""
+        operands = [
+            (evaluate, inspect.iscoroutinefunction(evaluate))
+            for evaluate in map(self._compile_value, operation["values"])
+        ]
+
+        async def evaluate_and(context: RuleContext, node: PathNode) -> bool:
             with logger.indent_block("AND"):
                 values = []
-                for v in operation["values"]:
-                    r = await self._evaluate_value(v, context)
+                for evaluate, is_async in operands:
+                    r = await evaluate(context) if is_async else evaluate(context)
                     values.append(r)
                     if not bool(r):
                         logger.debug("False value found in an AND, no need to compute the rest, breaking.")
                         break
                 result = all(bool(v) for v in values)
 
-            node.details["evaluated_values"] = values
-            logger.debug(f"Result {list(values)} AND: {result}")
+            if node is not None:
+                node.details["evaluated_values"] = values
+            logger.debug("Result %s AND: %s", values, result)
+            return result
+
+        return evaluate_and
+
+    def _compile_or(self, op_type: str, operation: dict[str, Any]) -> OperationBody:
+        """Compile an OR operation, which stops at the first true value"""
+        operands = [
+            (evaluate, inspect.iscoroutinefunction(evaluate))
+            for evaluate in map(self._compile_value, operation["values"])
+        ]
 
-        elif op_type == "OR":
+        async def evaluate_or(context: RuleContext, node: PathNode) -> bool:
             with logger.indent_block("OR"):
                 values = []
-                for v in operation["values"]:
-                    r = await self._evaluate_value(v, context)
+                for evaluate, is_async in operands:
+                    r = await evaluate(context) if is_async else evaluate(context)
                     values.append(r)
                     if bool(r):
                         logger.debug("True value found in an OR, no need to compute the other, breaking.")
                         break
                 result = any(bool(v) for v in values)
-            node.details["evaluated_values"] = values
-            logger.debug(f"Result {list(values)} OR: {result}")
+            if node is not None:
+                node.details["evaluated_values"] = values
+            logger.debug("Result %s OR: %s", values, result)
+            return result
+
+        return evaluate_or
 
-        elif "_DATE" in op_type:
-            values = [await self._evaluate_value(v, context) for v in operation["values"]]
-            unit = operation.get("unit", "days")
+    def _compile_date_operation(self, op_type: str, operation: dict[str, Any]) -> OperationBody:
+        """Compile a date operation"""
+        unit = operation.get("unit", "days")
+
+        def finish(node: PathNode, values: list[Any]) -> int:
             result = self._evaluate_date_operation(op_type, values, unit)
-            node.details.update({"evaluated_values": values, "unit": unit})
+            if node is not None:
+                node.details.update({"evaluated_values": values, "unit": unit})
+            return result
 
-        elif op_type in self.COMPARISON_OPS:
+        return self._compile_operands([self._compile_value(v) for v in operation["values"]], finish)
+
+    def _compile_comparison(self, op_type: str, operation: dict[str, Any]) -> OperationBody:
+        """Compile a comparison on either subject/value or two values"""
+        compare = self.COMPARISON_OPS[op_type]
+        if "subject" in operation:
+            operands = [operation["subject"], operation["value"]]
+        elif "values" in operation:
+            operands = operation["values"]
+        else:
+            operands = None
+
+        def finish(node: PathNode, values: list[Any]) -> bool | None:
             subject = None
             value = None
 
-            if "subject" in operation:
-                subject = await self._evaluate_value(operation["subject"], context)
-                value = await self._evaluate_value(operation["value"], context)
-
-            elif "values" in operation:
-                values = [await self._evaluate_value(v, context) for v in operation["values"]]
+            if operands is not None:
                 subject = values[0]
                 value = values[1]
             else:
                 logger.warning("Comparison operation expects two values or subject/value.")
 
-            result = self._evaluate_comparison(op_type, subject, value)
+            result = self._evaluate_comparison(op_type, compare, subject, value)
 
-            node.details.update(
-                {
-                    "subject_value": subject,
-                    "comparison_value": value,
-                    "comparison_type": op_type,
-                }
+            if node is not None:
+                node.details.update(
+                    {
+                        "subject_value": subject,
+                        "comparison_value": value,
+                        "comparison_type": op_type,
+                    }
+                )
+            return result
+
+        return self._compile_operands([self._compile_value(v) for v in operands or []], finish)
+
+    def _compile_aggregate(self, op_type: str, operation: dict[str, Any]) -> OperationBody:
+        """Compile an aggregate operation over a list of values"""
+        if "values" not in operation:
+            return self._compile_invalid_operation(op_type)
+
+        aggregate = self.AGGREGATE_OPS[op_type]
+        raw_values = operation["values"]
+
+        def finish(node: PathNode, values: list[Any]) -> int | float | bool:
+            result = self._evaluate_aggregate_ops(op_type, aggregate, values)
+            if node is not None:
+                node.details.update(
+                    {
+                        "raw_values": raw_values,
+                        "evaluated_values": values,
+                        "arithmetic_type": op_type,
+                    }
+                )
+            return result
+
+        return self._compile_operands([self._compile_value(v) for v in raw_values], finish)
+
+    def _compile_if_operation(self, op_type: str, operation: dict[str, Any]) -> OperationBody:
+        """Compile an IF operation"""
+        find_condition = self._compile_if_thresholds(operation.get("conditions", []))
+        conditions = []
+        for i, condition in enumerate(operation.get("conditions", [])):
+            if "test" in condition:
+                test = self._compile_operation(condition["test"])
+                # Only needed once the test holds
+                then = (
+                    self._compile_value(condition["then"])
+                    if "then" in condition
+                    else self._compile_failure(KeyError("then"))
+                )
+                condition_type = "test"
+            elif "else" in condition:
+                test = None
+                then = self._compile_value(condition["else"])
+                condition_type = "else"
+            else:
+                test = None
+                then = None
+                condition_type = "else"
+            conditions.append(
+                (
+                    i,
+                    condition_type,
+                    test,
+                    inspect.iscoroutinefunction(test),
+                    then,
+                    inspect.iscoroutinefunction(then),
+                )
             )
 
-        elif op_type in self.AGGREGATE_OPS and "values" in operation:
-            values = [await self._evaluate_value(v, context) for v in operation["values"]]
-            result = self._evaluate_aggregate_ops(op_type, values)
-            node.details.update(
-                {
-                    "raw_values": operation["values"],
-                    "evaluated_values": values,
-                    "arithmetic_type": op_type,
-                }
+        async def evaluate_if(context: RuleContext, node: PathNode) -> Any:
+            if not context.trace:
+                index = await find_condition(context) if find_condition is not None else None
+                if index is not None:
+                    if index == len(conditions):
+                        return 0
+                    _, _, _, _, then, then_async = conditions[index]
+                    return await then(context) if then_async else then(context)
+
+                for _, _, test, test_async, then, then_async in conditions:
+                    if test is not None:
+                        test_result = await test(context) if test_async else test(context)
+                        if test_result:
+                            return await then(context) if then_async else then(context)
+                    elif then is not None:
+                        return await then(context) if then_async else then(context)
+                return 0
+
+            if_node = PathNode(
+                type="operation",
+                name="IF conditions",
+                result=None,
+                details={"condition_results": []},
             )
+            context.add_to_path(if_node)
 
-        else:
+            result = 0
+
+            for i, condition_type, test, test_async, then, then_async in conditions:
+                condition_result = {
+                    "condition_index": i,
+                    "type": condition_type,
+                }
+
+                if test is not None:
+                    test_result = await test(context) if test_async else test(context)
+                    condition_result["test_result"] = test_result
+                    if test_result:
+                        result = await then(context) if then_async else then(context)
+                        condition_result["then_value"] = result
+                        if_node.details["condition_results"].append(condition_result)
+                        break
+                elif then is not None:
+                    result = await then(context) if then_async else then(context)
+                    condition_result["else_value"] = result
+                    if_node.details["condition_results"].append(condition_result)
+                    break
+
+                if_node.details["condition_results"].append(condition_result)
+
+            if_node.result = result
+            context.pop_path()
+            return result
+
+        return evaluate_if
+
+    def _compile_if_thresholds(self, conditions: list[Any]) -> Callable[[RuleContext], Awaitable[int | None]] | None:
+        """
+        Compile an IF chain whose tests all compare one reference against ordered literal thresholds
+        (brackets) into a bisect lookup of the first condition that holds. Returns None for other chains.
+        The lookup returns None when the value cannot be bisected safely, so the chain is tested in turn.
+        """
+        tests = []
+        for condition in conditions:
+            if not isinstance(condition, dict) or "test" not in condition:
+                break
+            tests.append(condition["test"])
+        trailing = conditions[len(tests) :]
+        if len(tests) < 2 or len(trailing) > 1 or (trailing and "else" not in trailing[0]):
+            return None
+
+        op_types = set()
+        subjects = set()
+        thresholds = []
+        for test in tests:
+            if not isinstance(test, dict):
+                return None
+            operands = [test.get("subject"), test.get("value")] if "subject" in test else test.get("values")
+            if not isinstance(operands, list) or len(operands) != 2:
+                return None
+            subject, threshold = operands
+            if not (isinstance(subject, str) and subject.startswith("$")):
+                return None
+            if isinstance(threshold, bool) or not isinstance(threshold, int | float | str):
+                return None
+            if isinstance(threshold, str) and threshold.startswith("$"):
+                return None
+            op_types.add(test.get("operation"))
+            subjects.add(subject)
+            thresholds.append(threshold)
+
+        if len(op_types) != 1 or len(subjects) != 1:
+            return None
+        op_type = op_types.pop()
+        if op_type not in self.IF_THRESHOLD_OPS:
+            return None
+        ascending, find = self.IF_THRESHOLD_OPS[op_type]
+
+        def strictly_ascending(keys: list[Any]) -> bool:
+            try:
+                return all(a < b for a, b in itertools.pairwise(keys))
+            except TypeError:
+                return False
+
+        keys = thresholds if ascending else thresholds[::-1]
+        if not strictly_ascending(keys):
+            return None
+
+        # The thresholds as compared with a date subject
+        date_keys = None
+        if all(isinstance(key, str) for key in keys):
+            try:
+                date_keys = [self._coerce_operand(date.min, key) for key in keys]
+            except ValueError:
+                date_keys = None
+            if date_keys is not None and not strictly_ascending(date_keys):
+                date_keys = None
+
+        resolve = self._compile_value(subjects.pop())
+        count = len(keys)
+        # String thresholds are resolved like references, and so end up in the resolved paths
+        resolved_thresholds = isinstance(thresholds[0], str)
+
+        async def find_condition(context: RuleContext) -> int | None:
+            value = await resolve(context)
+            if type(value) not in self.IF_THRESHOLD_TYPES or value != value:
+                return None
+            table = keys
+            if isinstance(value, date) and isinstance(keys[0], str):
+                if date_keys is None:
+                    return None
+                table = date_keys
+            try:
+                found = find(table, value)
+            except TypeError:
+                # Incomparable, so none of the tests holds
+                found = count if ascending else 0
+            index = found if ascending else count - found
+            logger.debug("Compute IF %s(%s) on %d thresholds: condition %d", op_type, value, count, index)
+            if resolved_thresholds:
+                # As if the tests were run in turn, up to the one that holds
+                for threshold in thresholds[: index + 1]:
+                    context.resolved_paths[threshold] = threshold
+            return index
+
+        return find_condition
+
+    def _compile_foreach(self, op_type: str, operation: dict[str, Any]) -> OperationBody:
+        """Compile a FOREACH operation"""
+        combine = operation.get("combine")
+        aggregate = self.AGGREGATE_OPS.get(combine)
+        raw_values = operation["value"]
+        subject_evaluator = self._compile_value(operation["subject"])
+        subject_async = inspect.iscoroutinefunction(subject_evaluator)
+        value_evaluator = self._compile_value(raw_values[0] if isinstance(raw_values, list) else raw_values)
+        value_async = inspect.iscoroutinefunction(value_evaluator)
+
+        async def evaluate_foreach(context: RuleContext, node: PathNode) -> Any:
+            array_data = await subject_evaluator(context) if subject_async else subject_evaluator(context)
+            if not array_data:
+                logger.warning("No data found to run FOREACH on")
+                result = self._evaluate_aggregate_ops(combine, aggregate, [])
+            else:
+                if not isinstance(array_data, list):
+                    array_data = [array_data]
+
+                with logger.indent_block("Foreach(%s)", combine):
+                    values = []
+                    for item in array_data:
+                        with logger.indent_block("Item %s", item):
+                            item_context = copy(context)
+                            item_context.local = item
+                            result = (
+                                await value_evaluator(item_context) if value_async else value_evaluator(item_context)
+                            )
+                            values.extend(result if isinstance(result, list) else [result])
+                    logger.debug("Foreach values: %s", values)
+                    result = self._evaluate_aggregate_ops(combine, aggregate, values)
+                    logger.debug("Foreach result: %s", result)
+
+            if node is not None:
+                node.details.update({"raw_values": raw_values, "arithmetic_type": op_type})
+            return result
+
+        return evaluate_foreach
+
+    COMPARISON_OPS = {
+        "EQUALS": operator.eq,
+        "NOT_EQUALS": operator.ne,
+        "GREATER_THAN": operator.gt,
+        "LESS_THAN": operator.lt,
+        "GREATER_OR_EQUAL": operator.ge,
+        "LESS_OR_EQUAL": operator.le,
+    }
+
+    AGGREGATE_OPS = {
+        "OR": any,
+        "AND": all,
+        "MIN": min,
+        "MAX": max,
+        "ADD": sum,
+        "CONCAT": lambda vals: "".join(str(x) for x in vals),
+        "MULTIPLY": _multiply,
+        "SUBTRACT": _subtract,
+        "DIVIDE": _divide,
+    }
+
+    # Difference between an end and a start date, per unit. Only days need the full timedelta.
+    DATE_UNIT_OPS = {
+        "days": lambda end, start: (end - start).days,
+        "years": lambda end, start: (
+            end.year - start.year - (end.month < start.month or (end.month == start.month and end.day < start.day))
+        ),
+        "months": lambda end, start: (end.year - start.year) * 12 + end.month - start.month,
+    }
+
+    # Threshold comparisons an IF chain can be bisected on: op -> (thresholds ascend, bisect function giving
+    # the first test that holds, or for descending thresholds the number of tests that hold)
+    IF_THRESHOLD_OPS = {
+        "LESS_THAN": (True, bisect.bisect_right),
+        "LESS_OR_EQUAL": (True, bisect.bisect_left),
+        "GREATER_THAN": (False, bisect.bisect_left),
+        "GREATER_OR_EQUAL": (False, bisect.bisect_right),
+    }
+    # Subject types that are totally ordered against their thresholds
+    IF_THRESHOLD_TYPES = frozenset({int, float, str, date})
+
+    # Operation type -> compiler of the operation body, so an operation is dispatched with a single lookup
+    OP_HANDLERS: dict[str, Callable[["RulesEngine", str, dict[str, Any]], OperationBody]] = {
+        **dict.fromkeys(AGGREGATE_OPS, _compile_aggregate),
+        **dict.fromkeys(COMPARISON_OPS, _compile_comparison),
+        "IF": _compile_if_operation,
+        "FOREACH": _compile_foreach,
+        "IN": _compile_in,
+        "NOT_IN": _compile_in,
+        "NOT_NULL": _compile_not_null,
+        "AND": _compile_and,
+        "OR": _compile_or,
+        "SUBTRACT_DATE": _compile_date_operation,
+    }
+
+    @staticmethod
+    def _evaluate_aggregate_ops(
+        op: str, aggregate: Callable[[list[Any]], Any], values: list[Any]
+    ) -> int | float | bool:
+        """Handle aggregate operations"""
+        filtered_values = [v for v in values if v is not None]
+
+        if not filtered_values:
+            logger.warning(f"No values found (or they where None), returning 0 for {op}({values})")
+            return 0
+        elif len(filtered_values) < len(values):
+            logger.warning(f"Dropped {len(values) - len(filtered_values)} values because they where None")
+
+        result = aggregate(filtered_values)
+        logger.debug("Compute %s(%s) = %s", op, filtered_values, result)
+        return result
+
+    @staticmethod
+    def _coerce_operand(other: Any, operand: Any) -> Any:
+        """Coerce an operand to the type it is compared with: a (YYYY-MM-DD) string compared with a date is parsed"""
+        if isinstance(other, date) and isinstance(operand, str):
+            return datetime.strptime(operand, "%Y-%m-%d").date()
+        return operand
+
+    @staticmethod
+    def _evaluate_comparison(op: str, compare: Callable[[Any, Any], bool], left: Any, right: Any) -> bool | None:
+        """Handle comparison operations"""
+        right = RulesEngine._coerce_operand(left, right)
+        left = RulesEngine._coerce_operand(right, left)
+
+        try:
+            result = compare(left, right)
+            logger.debug("Compute %s(%s, %s) = %s", op, left, right, result)
+        except TypeError as e:
+            logger.warning(f"Error computing {op}({left}, {right}): {e}")
             result = None
-            node.details["error"] = "Invalid operation format"
-            logger.warning(f"Not matched to any operation {op_type}")
 
-        node.result = result
-        context.pop_path()
         return result
 
-    async def _evaluate_value(self, value: Any, context: RuleContext) -> Any:
-        """Evaluate a value which might be a number, operation, or reference"""
-        if isinstance(value, int | float | bool | date | datetime):
-            return value
-        elif isinstance(value, dict) and "operation" in value:
-            return await self._evaluate_operation(value, context)
-        else:
-            return await context.resolve_value(value)
+    @staticmethod
+    def _evaluate_date_operation(op: str, values: list[Any], unit: str) -> int:
+        """Handle date-specific operations"""
+        result = None
+        if op == "SUBTRACT_DATE":
+            if len(values) != 2:
+                logger.warning("Warning: SUBTRACT_DATE requires exactly 2 values")
+                return 0
+
+            end_date, start_date = values
+
+            if not isinstance(end_date, datetime):
+                end_date = parse_iso(str(end_date))
+            if not isinstance(start_date, datetime):
+                start_date = parse_iso(str(start_date))
+
+            difference = RulesEngine.DATE_UNIT_OPS.get(unit)
+            if difference is not None:
+                result = difference(end_date, start_date)
+            else:
+                logger.warning(f"Warning: Unknown date unit {unit}")
+            logger.debug("Compute %s(%s, %s) = %s", op, values, unit, result)
+
+        if result is None:
+            logger.warning("Warning: date operation resulted in None")
+
+        return result
@@ -53,27 +53,33 @@ class IndentLogger:
     def __init__(self, logger: logging.Logger) -> None:
         self._logger = logger
 
+    # The indent is only built for records that are actually emitted; pass values as
+    # %-style args rather than f-strings so their formatting is deferred as well
     def debug(self, msg: str, *args, **kwargs) -> None:
-        self._logger.debug(f"{self.indent}{msg}", *args, **kwargs)
+        if self._logger.isEnabledFor(logging.DEBUG):
+            self._logger.debug(f"{self.indent}{msg}", *args, **kwargs)
 
     def info(self, msg: str, *args, **kwargs) -> None:
-        self._logger.info(f"{self.indent}{msg}", *args, **kwargs)
+        if self._logger.isEnabledFor(logging.INFO):
+            self._logger.info(f"{self.indent}{msg}", *args, **kwargs)
 
     def warning(self, msg: str, *args, **kwargs) -> None:
-        self._logger.warning(f"{self.indent}{msg}", *args, **kwargs)
+        if self._logger.isEnabledFor(logging.WARNING):
+            self._logger.warning(f"{self.indent}{msg}", *args, **kwargs)
 
     def error(self, msg: str, *args, **kwargs) -> None:
-        self._logger.error(f"{self.indent}{msg}", *args, **kwargs)
+        if self._logger.isEnabledFor(logging.ERROR):
+            self._logger.error(f"{self.indent}{msg}", *args, **kwargs)
 
     @property
     def indent(self) -> str:
         return GlobalIndent.get_indent()
 
     @contextmanager
-    def indent_block(self, initial_message: str | None = None, double_line: bool = False):
+    def indent_block(self, initial_message: str | None = None, *args, double_line: bool = False):
         """Context manager for handling indentation blocks"""
         if initial_message:
-            self.debug(initial_message)
+            self.debug(initial_message, *args)
         GlobalIndent.increase(double_line)
         try:
             yield
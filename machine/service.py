@@ -81,6 +81,7 @@ class RuleService:
         overwrite_input: dict[str, Any] | None = None,
         requested_output: str | None = None,
         approved: bool = False,
+        trace: bool = False,
     ) -> RuleResult:
         """
         Evaluate rules for given law and reference date
@@ -91,6 +92,7 @@ class RuleService:
             parameters: Context data for service provider
             overwrite_input: Optional overrides for input values
             requested_output: Optional specific output field to calculate
+            trace: Record the evaluation path, returned as RuleResult.path
 
         Returns:
             RuleResult containing outputs and metadata
@@ -103,6 +105,7 @@ class RuleService:
             calculation_date=reference_date,
             requested_output=requested_output,
             approved=approved,
+            trace=trace,
         )
         return RuleResult.from_engine_result(result, engine.spec.get("uuid"))
 
@@ -242,11 +245,11 @@ class Services:
         overwrite_input: dict[str, Any] | None = None,
         requested_output: str | None = None,
         approved: bool = False,
+        trace: bool = False,
     ) -> RuleResult:
         reference_date = reference_date or self.root_reference_date
         with logger.indent_block(
-            f"{service}: {law} ({reference_date} {parameters} {requested_output})",
-            double_line=True,
+            "%s: %s (%s %s %s)", service, law, reference_date, parameters, requested_output, double_line=True
         ):
             return await self.services[service].evaluate(
                 law=law,
@@ -255,6 +258,7 @@ class Services:
                 overwrite_input=overwrite_input,
                 requested_output=requested_output,
                 approved=approved,
+                trace=trace,
             )
 
     async def apply_rules(self, event) -> None:
@@ -27,8 +27,10 @@ def get_tile_template(service: str, law: str) -> str:
         return "partials/tiles/fallback_tile.html"
 
 
-async def evaluate_law(bsn: str, law: str, service: str, services: Services, approved: bool = True):
-    """Evaluate a law for a given BSN"""
+async def evaluate_law(
+    bsn: str, law: str, service: str, services: Services, approved: bool = True, trace: bool = False
+):
+    """Evaluate a law for a given BSN, recording the evaluation path when trace is set"""
     # Get the rule specification
     rule_spec = services.resolver.get_rule_spec(law, TODAY, service)
     if not rule_spec:
@@ -48,7 +50,9 @@ async def evaluate_law(bsn: str, law: str, service: str, services: Services, app
     parameters = {"BSN": bsn}
 
     # Execute the law
-    result = await services.evaluate(service, law=law, parameters=parameters, reference_date=TODAY, approved=approved)
+    result = await services.evaluate(
+        service, law=law, parameters=parameters, reference_date=TODAY, approved=approved, trace=trace
+    )
     return law, result, rule_spec, parameters
 
 
@@ -205,7 +209,9 @@ async def explanation(
     """Get a citizen-friendly explanation of the rule evaluation path"""
     try:
         law = unquote(law)
-        law, result, rule_spec, parameters = await evaluate_law(bsn, law, service, services, approved=approved)
+        law, result, rule_spec, parameters = await evaluate_law(
+            bsn, law, service, services, approved=approved, trace=True
+        )
 
         # Convert path and rule_spec to JSON strings
         path_dict = node_to_dict(result.path)
@@ -259,7 +265,9 @@ async def application_panel(
     """Get the application panel with tabs"""
     try:
         law = unquote(law)
-        law, result, rule_spec, parameters = await evaluate_law(bsn, law, service, services, approved=approved)
+        law, result, rule_spec, parameters = await evaluate_law(
+            bsn, law, service, services, approved=approved, trace=True
+        )
         value_tree = services.extract_value_tree(result.path)
         existing_case = services.case_manager.get_case(bsn, service, law)
 